@@ -1,16 +1,19 @@
+import os
+import functools
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
-import numpy as np
-import pandas as pd
-import plotly.express as px
 from datetime import datetime as dt
 
-import plotly.graph_objects as go
 from dateutil.relativedelta import * 
-from database import fetch_all_crime_as_df 
+# numpy, pandas, plotly and the db layer are imported inside the callbacks that need them, so
+# importing this module (a cold start or a new worker) only pays for dash itself.
 
 # Definitions of constants. This projects uses extra CSS stylesheet at `./assets/style.css`
+# With LACRIME_FAST_START=1 the server starts without preloading the dataset; the first
+# callback loads it instead.
+FAST_START = os.environ.get('LACRIME_FAST_START') == '1'
 COLORS = ['rgb(67,67,67)', 'rgb(115,115,115)', 'rgb(49,130,189)', 'rgb(189,189,189)', 'rgb(240,240,240)']
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css', '/assets/style.css']
@@ -105,6 +108,10 @@ def what_if_tool():
                 start_date = dt(2018,12,1), end_date=dt(2019, 8, 1))
             ], style={'width':'40%'}),
         ], className='row', style={'marginLeft': 5}), #'marginTop': '5%'
+        html.Div(children=[
+            html.H5("Unusual days"),
+            dcc.Markdown(id='anomaly-output')
+        ], className='row', style={'marginLeft': 5, 'marginTop': '2%'}),
     ], className='row eleven columns')
 
 def crime_map_description():
@@ -178,6 +185,7 @@ def data_acquisition_summary():
             * Use API to query history records from January 1st, 2018 and load it into MongoDB (load_data.py)
             * data_acquire.py will check every 15 seconds and call the function upsert_crime from database.py
             * Before the app server is up, fetch_all_crime_as_df will be called and the results will be cached to reduce access latency
+            * upsert_crime publishes a new dataset version listing the changed months, and the app refreshes only those months in its caches
             * app server will run alongside with data_acquire.py to capture real-time updates, also providing an interface for the user to explore crime rate trend
                   
             Links:
@@ -246,7 +254,9 @@ def reference():
 
 
 
-# Sequentially add page components to the app's layout
+# Sequentially add page components to the app's layout. Every section is static, so the tree
+# is built on the first page load and reused afterwards.
+@functools.lru_cache(maxsize=1)
 def dynamic_layout():
     return html.Div([
         page_header(),
@@ -265,7 +275,7 @@ def dynamic_layout():
     ], className='row', id='content')
 
 
-# set layout to a function which updates upon reloading
+# set layout to a function; dash calls it per page load and it returns the cached tree
 app.layout = dynamic_layout
 
 @app.callback(
@@ -274,24 +284,24 @@ app.layout = dynamic_layout
      dash.dependencies.Input('my-date-picker-range', 'end_date')])
 def what_if_handler(startdate, enddate):
     """Changes the display graph of crime rates"""
-    df = fetch_all_crime_as_df(allow_cached=True)
-    if df is None:
-        return go.Figure()
-    c = df.groupby(['grp_description','month']).count()
-    crime = ['Miscellaneous Other Violations', 'Narcotic Drug Laws', 'Aggravated Assault', 'Driving Under Influence', 'Other Assaults']
+    import pandas as pd
+    import plotly.graph_objects as go
+    from database import fetch_monthly_counts
     start = pd.Timestamp(startdate)
     end = pd.Timestamp(enddate)
     start = pd.Timestamp(dt(start.year, start.month, 1))
     end = pd.Timestamp(dt(end.year, end.month, 1))
+    counts = fetch_monthly_counts(start, end)
+    if len(counts.columns) == 0:
+        return go.Figure()
+    crime = ['Miscellaneous Other Violations', 'Narcotic Drug Laws', 'Aggravated Assault', 'Driving Under Influence', 'Other Assaults']
     month_range_num = round(((end - start).days)/30)
     test_axis = [start + relativedelta(months=+i) for i in range(month_range_num + 1)]
+    c = counts.reindex(index=test_axis, columns=crime, fill_value=0)
     title = 'Crime counts of top five categories'
     fig = go.Figure()
     for i, s in enumerate(crime):
-        count_array = c.loc[s]['rpt_id']
-        #print(count_array)
-        count = [count_array[x] for x in test_axis]
-        fig.add_trace(go.Scatter(x=test_axis, y=count, mode='lines', name=s,
+        fig.add_trace(go.Scatter(x=test_axis, y=c[s], mode='lines', name=s,
                                  line={'width': 2, 'color': COLORS[i]},
                                  stackgroup=False))
     fig.update_layout(template='plotly_dark', title=title,
@@ -299,6 +309,20 @@ def what_if_handler(startdate, enddate):
                       xaxis_title='Month')
     return fig  
 
+@app.callback(
+    dash.dependencies.Output('anomaly-output', 'children'),
+    [dash.dependencies.Input('my-date-picker-range', 'start_date'),
+     dash.dependencies.Input('my-date-picker-range', 'end_date')])
+def anomaly_handler(startdate, enddate):
+    """Lists the days with unusual arrest counts per area or crime group, read from the
+    rolling statistics maintained during ingest"""
+    from database import fetch_anomalies
+    days = fetch_anomalies(startdate, enddate)
+    if len(days) == 0:
+        return 'No unusual days in this time frame.'
+    return '\n'.join('* {day} {key} ({kind}): {count} arrests, {z:+.1f} standard deviations from '
+                     'the recent average of {mean:.1f}'.format(**day) for day in days)
+
 @app.callback(
     dash.dependencies.Output('what-if-crime', 'figure'),
     [dash.dependencies.Input('crime-date-picker-range', 'start_date'),
@@ -306,7 +330,12 @@ def what_if_handler(startdate, enddate):
      dash.dependencies.Input('crime-dropdown', 'value'),])
 def crime_handler(startdate, enddate, crimetype):
     """Changes the display graph of crime rates"""
-    df = fetch_all_crime_as_df(allow_cached=True)
+    import numpy as np
+    import pandas as pd
+    import plotly.graph_objects as go
+    from database import fetch_crime_as_df
+    from figures import crime_map_figure
+    df = fetch_crime_as_df(startdate, enddate, allow_cached=True)
     if df is None:
         return go.Figure()
     df.dropna(subset=['grp_description'],inplace=True)
@@ -319,12 +348,7 @@ def crime_handler(startdate, enddate, crimetype):
     df[['lat','lon']] = df[['lat','lon']].replace(to_replace =[0], value = np.nan)
     df.dropna(subset=['lat','lon'],inplace=True)
     df_map = df[(df['arst_date'] <= enddate)&(df['arst_date'] >= startdate)&(df['crime_type']==crimetype)]
-    title = 'Crime map'
-    fig = px.scatter_mapbox(df_map, lat='lat', lon='lon', zoom=10, height=500, color='area_desc')
-    fig.update_traces(marker=dict(size=12, opacity=0.5))
-    fig.update_layout(mapbox_style="stamen-terrain")
-    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0}, title=title)
-    return fig  
+    return crime_map_figure(df_map)
 
 @app.callback(
     dash.dependencies.Output('dd-output-container', 'children'),
@@ -333,7 +357,27 @@ def update_output(value):
     return 'You have selected "{}"'.format(value)
 
 
+@app.server.route('/export')
+def export_handler():
+    """Streams records matching the query filters as CSV, NDJSON or Arrow, see `export.parse_filters`"""
+    from export import FORMATS, parse_filters, export_stream
+    fmt = flask.request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        return flask.Response('format must be one of {}'.format(', '.join(FORMATS)), status=400)
+    try:
+        filters = parse_filters(flask.request.args)
+    except ValueError as e:
+        return flask.Response(str(e), status=400)
+    gzip = 'gzip' in flask.request.headers.get('Accept-Encoding', '')
+    headers = {'Content-Disposition': 'attachment; filename=crime.{}'.format(fmt)}
+    if gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return flask.Response(flask.stream_with_context(export_stream(filters, fmt, gzip)),
+                          mimetype=FORMATS[fmt], headers=headers)
+
 
 if __name__ == '__main__':
-    fetch_all_crime_as_df(allow_cached=True)
+    if not FAST_START:
+        from database import fetch_all_crime_as_df
+        fetch_all_crime_as_df(allow_cached=True)
     app.run_server(debug=True, port=1050, host='0.0.0.0')
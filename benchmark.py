@@ -0,0 +1,130 @@
+import sys
+import math
+import time
+import subprocess
+import resource
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from figures import crime_map_figure, payload_stats
+from export import ENCODERS, EXPORT_BATCH_SIZE, gzip_stream
+
+# Rough shape of the LA arrest data: 21 areas, a handful of crime groups, points around downtown.
+AREAS = ['Central', 'Rampart', 'Southwest', 'Hollenbeck', 'Harbor', 'Hollywood', 'Wilshire',
+         'West LA', 'Van Nuys', 'West Valley', 'Northeast', '77th Street', 'Newton', 'Pacific',
+         'N Hollywood', 'Foothill', 'Devonshire', 'Southeast', 'Mission', 'Olympic', 'Topanga']
+GROUPS = ['Miscellaneous Other Violations', 'Narcotic Drug Laws', 'Aggravated Assault',
+          'Driving Under Influence', 'Other Assaults', 'Homicide', 'Weapon (carry/poss)']
+
+
+def synthetic_crime_df(n, seed=0):
+    """Returns `n` synthetic records with the columns the app callbacks use.
+    """
+    rng = np.random.RandomState(seed)
+    dates = pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.randint(0, 700, n), unit='D')
+    return pd.DataFrame({
+        'rpt_id': np.arange(n).astype(str),
+        'arst_date': dates,
+        'grp_description': rng.choice(GROUPS, n),
+        'area_desc': rng.choice(AREAS, n),
+        'lat': 34.05 + rng.normal(0, 0.1, n),
+        'lon': -118.25 + rng.normal(0, 0.1, n),
+    })
+
+
+def bench_figures(n):
+    """Compares payload size and serialization time of the crime map before and after
+    `figures.crime_map_figure`.
+    """
+    df = synthetic_crime_df(n)
+    before = px.scatter_mapbox(df, lat='lat', lon='lon', zoom=10, height=500, color='area_desc')
+    before.update_traces(marker=dict(size=12, opacity=0.5))
+    after = crime_map_figure(df)
+    undecimated = crime_map_figure(df, max_bytes=None)    # encoding savings alone
+    for name, fig in [('before', before), ('after', after), ('after, no decimation', undecimated)]:
+        size, seconds = payload_stats(fig)
+        print("{:>20}: rows={}, points={}, bytes={}, serialize={:.3f}s".format(
+            name, n, sum(len(trace.lat) for trace in fig.data), size, seconds))
+
+
+# Remaining fields of a booking record, see ETL_EDA.ipynb, so exports carry realistic row widths.
+RECORD_FIELDS = {'report_type': 'BOOKING', 'time': '1205', 'area': '09', 'rd': '0935', 'age': '47',
+                 'sex_cd': 'M', 'descent_cd': 'W', 'chrg_grp_cd': '16', 'arst_typ_cd': 'M',
+                 'charge': '11350(A)HS', 'chrg_desc': 'POSSESSION OF CONTROLLED SUBSTANCE',
+                 'dispo_desc': 'FELONY COMPLAINT FILED', 'location': '14400    ERWIN STREET',
+                 'crsst': '', 'bkg_date': '2019-12-31T00:00:00.000', 'bkg_time': '1212',
+                 'bgk_location': 'VALLEY - JAIL DIV', 'bkg_loc_cd': '4279'}
+POOL_BATCHES = 10            # distinct batches generated for the export benchmark, then reused
+
+
+def synthetic_record_batches(n, batch_size=EXPORT_BATCH_SIZE):
+    """Yields `n` synthetic raw records (string fields, as stored in the db) in batches, so that
+    no more than one batch exists at a time.
+    """
+    for offset in range(0, n, batch_size):
+        df = synthetic_crime_df(min(batch_size, n - offset), seed=offset)
+        df['rpt_id'] = (df.index + offset).astype(str)
+        df['arst_date'] = df['arst_date'].dt.strftime('%Y-%m-%dT%H:%M:%S.000')
+        for field, value in RECORD_FIELDS.items():
+            df[field] = value
+        yield df.astype(str).to_dict('records')
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_export(n, fmt=None):
+    """Measures export throughput and peak memory of every format, gzipped, for `n` records.
+    Records are generated before the timer as `POOL_BATCHES` batches that are cycled through,
+    so the numbers cover encoding and compression only, not db/parquet reads or the generator.
+    Without `fmt`, every format runs in a fresh interpreter, because peak RSS never decreases;
+    the memory reported is the peak growth over the generated records.
+    """
+    if fmt is None:
+        for fmt in sorted(ENCODERS):
+            subprocess.run([sys.executable, __file__, 'export', str(n), fmt], check=True)
+        return
+    pool = list(synthetic_record_batches(min(n, POOL_BATCHES * EXPORT_BATCH_SIZE)))
+    batches = (pool[i % len(pool)] for i in range(int(math.ceil(n / float(EXPORT_BATCH_SIZE)))))
+    baseline_mb = _peak_rss_mb()
+    start = time.perf_counter()
+    size = 0
+    for piece in gzip_stream(ENCODERS[fmt](batches)):
+        size += len(piece)
+    seconds = time.perf_counter() - start
+    print("{:>6}: rows={}, gzip_bytes={}, {:.1f}s, {:.0f} rows/s, peak_rss_growth={:.0f}MB".format(
+        fmt, n, size, seconds, n / seconds, _peak_rss_mb() - baseline_mb))
+
+
+def bench_imports(runs, module='app', top=15):
+    """Reports the cold import time of `module` (what a new worker pays before serving) as the
+    median over `runs` fresh interpreters, plus the slowest imports from `python -X importtime`.
+    """
+    walls = []
+    for _ in range(max(1, runs)):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                              stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        walls.append(time.perf_counter() - start)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2    # nested imports are indented by 2
+        if depth <= 1:      # the module itself and what it imports directly
+            imports.append((int(cumulative_us), int(self_us), name.strip()))
+    print("import {}: median wall={:.3f}s over {} runs".format(module, sorted(walls)[len(walls) // 2], len(walls)))
+    for cumulative_us, self_us, name in sorted(imports, reverse=True)[:top]:
+        print("{:>10.1f}ms cumulative {:>8.1f}ms self  {}".format(cumulative_us / 1000.0, self_us / 1000.0, name))
+
+
+BENCHMARKS = {'figures': bench_figures, 'export': bench_export, 'imports': bench_imports}
+
+if __name__ == '__main__':
+    # usage: python benchmark.py <figures|export|imports> [rows|runs] [format], e.g.
+    # `python benchmark.py export 1000000` or `python benchmark.py export 1000000 csv`
+    name = sys.argv[1] if len(sys.argv) > 1 else 'figures'
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    BENCHMARKS[name](rows, *sys.argv[3:])
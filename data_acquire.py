@@ -3,20 +3,21 @@ import sched
 import pandas as pd
 import logging
 import utils
-from database import upsert_crime 
+from database import upsert_crime, freeze_history, ensure_indexes
 from sodapy import Socrata
 from datetime import datetime
 from datetime import timedelta
 
 CRIME_SOURCE = "data.lacity.org"
 DOWNLOAD_PERIOD = 15         # second
+FREEZE_PERIOD = 3600         # second
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'data.log')
 
 def download_crime(url=CRIME_SOURCE, start_date = None):
     """Returns records from `CRIME_SOURCE` that includes crime and arrestee information.
     """
-    one_week_ago = datetime.now() - timedelta(days=5)
+    one_week_ago = datetime.now() - timedelta(days=utils.DOWNLOAD_WINDOW_DAYS)
     if start_date == None:
         start_date = one_week_ago.strftime('%Y-%m-%d') + 'T00:00:00.000'
     client = Socrata(url, None)
@@ -37,6 +38,10 @@ def update_once():
     
 def main_loop(timeout=DOWNLOAD_PERIOD):
     scheduler = sched.scheduler(time.time, time.sleep)
+    try:
+        ensure_indexes()                        # before the first upsert touches the statistics
+    except Exception as e:
+        logger.warning("main loop could not create indexes and continues: {}".format(e))
 
     def _worker():
         try:
@@ -45,7 +50,15 @@ def main_loop(timeout=DOWNLOAD_PERIOD):
             logger.warning("main loop worker ignores exception and continues: {}".format(e))
         scheduler.enter(timeout, 1, _worker)    # schedule the next event
 
+    def _freezer():
+        try:
+            freeze_history()
+        except Exception as e:
+            logger.warning("main loop freezer ignores exception and continues: {}".format(e))
+        scheduler.enter(FREEZE_PERIOD, 2, _freezer)
+
     scheduler.enter(0, 1, _worker)              # start the first event
+    scheduler.enter(0, 2, _freezer)
     scheduler.run(blocking=True)
 
 
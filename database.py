@@ -1,25 +1,76 @@
+import time
 import logging
+import functools
 import pandas as pd
 #from sodapy import Socrata
 from datetime import datetime
 import pymongo
 import expiringdict
 import utils
+import partitions
+import stats
 
 # !pip install expiringdict
 
-client = pymongo.MongoClient()
+_client = None
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'db.log')
 RESULT_CACHE_EXPIRATION = 2200
+PARTITION_CACHE_SIZE = 24        # frozen partitions kept in memory once read
+VERSION_POLL_PERIOD = 5          # second, minimum interval between dataset version checks
+CHANGES_TTL = 7 * 24 * 3600      # second, change log entries older than this are dropped by the db
+
+def get_client():
+    """Returns the shared `pymongo.MongoClient`, created on first use so that importing this
+    module (and forking workers) does not open a connection.
+    """
+    global _client
+    if _client is None:
+        _client = pymongo.MongoClient()
+    return _client
+
+
+_last_written = {'hashes': None}     # row hashes by `rpt_id` of the previous upsert batch
+
+
+def dedup_batch(df):
+    """Collapses duplicate `rpt_id`s in `df`, keeping the last row (the newest arrival), and
+    drops rows identical to the ones written by the previous batch, which the overlapping
+    download windows re-fetch every cycle. Both steps hash into pandas indexes instead of
+    comparing rows pairwise; row hashes come from `utils.row_hashes`. Returns
+    `(df, hashes, duplicates, unchanged, late)`: the rows to write, the row hashes to remember
+    once they are written, and the counts of dropped duplicates, dropped unchanged rows, and
+    late updates (rows seen before whose content changed).
+    """
+    rows = len(df)
+    if rows == 0:
+        return df, _last_written['hashes'], 0, 0, 0
+    df = df[~df['rpt_id'].duplicated(keep='last')]
+    hashes = utils.row_hashes(df)
+    hashes.index = pd.Index(df['rpt_id'])
+    unchanged = late = 0
+    previous = _last_written['hashes']
+    if previous is not None and len(df) > 0:
+        position = previous.index.get_indexer(hashes.index)
+        seen = position >= 0
+        same = seen & (previous.to_numpy()[position] == hashes.to_numpy())
+        unchanged, late = int(same.sum()), int((seen & ~same).sum())
+        df = df[~same]
+    return df, hashes, rows - len(hashes), unchanged, late
+
 
 def upsert_crime(df):
     """
     Update MongoDB database `crime` and collection `crime` with the given `DataFrame`.
+    Rows are deduplicated by `dedup_batch` first, so only real changes are written.
     """
-    db = client.get_database("crime")
+    db = get_client().get_database("crime")
     collection = db.get_collection("crime")
+    rows = df.shape[0]
+    df, hashes, duplicates, unchanged, late = dedup_batch(df)
     update_count = 0
+    changed = []
+    inserted = []
     if len(df) > 0:
         for record in df.to_dict('records'):
             result = collection.replace_one(
@@ -28,17 +79,124 @@ def upsert_crime(df):
                 upsert=True)
             if result.matched_count > 0:
                 update_count += 1
-    logger.info("rows={}, update={}, ".format(df.shape[0], update_count) +
-                "insert={}".format(df.shape[0]-update_count))
+            if result.upserted_id is not None or result.modified_count > 0:
+                changed.append(record)
+            if result.upserted_id is not None:
+                inserted.append(record)
+    _last_written['hashes'] = hashes
+    logger.info("rows={}, duplicates={}, unchanged={}, late_update={}, ".format(rows, duplicates, unchanged, late) +
+                "update={}, insert={}".format(update_count, df.shape[0]-update_count))
+    db.get_collection("meta").update_one(
+        {'_id': 'ingest'},
+        {'$inc': {'rows': rows, 'duplicates': duplicates, 'unchanged': unchanged,
+                  'late_updates': late, 'updates': update_count, 'inserts': df.shape[0] - update_count}},
+        upsert=True)
+    if len(changed) > 0:
+        publish_change(months=[partitions.month_key(r['arst_date']) for r in changed],
+                       categories=[r.get('grp_description') for r in changed],
+                       rows=len(changed))
+    stats.update_stats(db, inserted)
+
+
+def rebuild_stats(records):
+    """Recomputes the rolling statistics in `stats` from scratch out of `records`, for a full
+    reload where `upsert_crime` is bypassed.
+    """
+    db = get_client().get_database("crime")
+    stats.reset_stats(db)
+    stats.update_stats(db, records)
+
+
+def fetch_anomalies(start, end, threshold=stats.ANOMALY_Z):
+    """Returns the most unusual days between `start` and `end` from the statistics collection,
+    see `stats.fetch_anomalies`.
+    """
+    return stats.fetch_anomalies(get_client().get_database("crime"), start, end, threshold)
+
+
+def publish_change(months, categories=(), rows=0):
+    """Bumps the dataset version in collection `meta` and records which `months` and
+    `categories` changed in collection `changes`, so app processes can refresh only those.
+    Returns the new version.
+    """
+    db = get_client().get_database("crime")
+    meta = db.get_collection("meta").find_one_and_update(
+        {'_id': 'dataset'}, {'$inc': {'version': 1}},
+        upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+    months = sorted(set(months))
+    categories = sorted(set(c for c in categories if isinstance(c, str)))
+    db.get_collection("changes").insert_one({'version': meta['version'], 'months': months,
+                                             'categories': categories, 'rows': rows,
+                                             'time': datetime.utcnow()})
+    logger.info("version={}, months={}, categories={}".format(meta['version'], months, len(categories)))
+    return meta['version']
 
 def fetch_all_crime():
-    db = client.get_database("crime")
+    db = get_client().get_database("crime")
     collection = db.get_collection("crime")
     ret = list(collection.find())
     logger.info(str(len(ret)) + ' documents read from the db')
     return ret
 
 
+def ensure_indexes():
+    """Creates the indexes used by date range, category and area queries on collection `crime`,
+    the version index and `CHANGES_TTL` expiry of the change log polled by `sync_dataset_version`,
+    and those of the statistics collections, see `stats.ensure_indexes`.
+    """
+    stats.ensure_indexes(get_client().get_database("crime"))
+    changes = get_client().get_database("crime").get_collection("changes")
+    changes.create_index('version')
+    changes.create_index('time', expireAfterSeconds=CHANGES_TTL)
+    collection = get_client().get_database("crime").get_collection("crime")
+    collection.create_index('rpt_id')
+    collection.create_index([('arst_date', pymongo.ASCENDING), ('grp_description', pymongo.ASCENDING)])
+    collection.create_index([('area_desc', pymongo.ASCENDING), ('arst_date', pymongo.ASCENDING)])
+
+
+def iter_crime(query, batch_size=10000):
+    """Yields documents of collection `crime` matching `query` in `arst_date` order as lists
+    of at most `batch_size` dicts, streaming from the cursor instead of materializing the result.
+    """
+    collection = get_client().get_database("crime").get_collection("crime")
+    cursor = collection.find(query, {'_id': 0}).sort('arst_date', pymongo.ASCENDING).batch_size(batch_size)
+    chunk = []
+    for document in cursor:
+        chunk.append(document)
+        if len(chunk) == batch_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def freeze_history():
+    """Moves complete months older than the hot window from collection `crime` into
+    immutable partition files, see `partitions.freeze_history`.
+    """
+    collection = get_client().get_database("crime").get_collection("crime")
+    ensure_indexes()
+    names = partitions.freeze_history(collection)
+    if len(names) > 0:
+        manifest = partitions.read_manifest()
+        publish_change(months=[manifest[name]['month'] for name in names if name in manifest])
+    return names
+
+
+def _prepare_crime_df(df):
+    """Parses `arst_date` and adds the `month_string` and `month` columns used by the app.
+    """
+    df['arst_date'] = pd.to_datetime(df['arst_date'])
+    df['month_string'] = df['arst_date'].dt.year.astype(str) + '-' + df['arst_date'].dt.month.astype(str)
+    df['month'] = df['arst_date'].dt.to_period('M').dt.to_timestamp()
+    return df
+
+
+@functools.lru_cache(maxsize=PARTITION_CACHE_SIZE)
+def _fetch_partition_as_df(name):
+    return _prepare_crime_df(partitions.read_partition(name))
+
+
 _fetch_all_crime_as_df_cache = expiringdict.ExpiringDict(max_len=1,
                                                        max_age_seconds=RESULT_CACHE_EXPIRATION)
 
@@ -46,7 +204,7 @@ def fetch_all_crime_as_df(allow_cached=False):
     """Converts list of dicts returned by `fetch_all_crime` to DataFrame with ID removed
     Actual job is done in `_worker`. When `allow_cached`, attempt to retrieve timed cached from
     `_fetch_all_crime_as_df_cache`; ignore cache and call `_work` if cache expires or `allow_cached`
-    is False.
+    is False. Only the hot window still in the db is covered, see `fetch_crime_as_df` for history.
     """
     def _work():
         data = fetch_all_crime()
@@ -54,12 +212,10 @@ def fetch_all_crime_as_df(allow_cached=False):
             return None
         df = pd.DataFrame.from_records(data)
         df.drop('_id', axis=1, inplace=True)
-        df['arst_date'] = pd.to_datetime(df['arst_date'])
-        df['month_string'] = df['arst_date'].apply(lambda x:str(x.year) + '-' + str(x.month))
-        df['month'] = pd.to_datetime(df['month_string'])
-        return df
+        return _prepare_crime_df(df)
 
     if allow_cached:
+        sync_dataset_version()
         try:
             return _fetch_all_crime_as_df_cache['cache']
         except KeyError:
@@ -69,6 +225,133 @@ def fetch_all_crime_as_df(allow_cached=False):
     return ret
 
 
+_dataset_state = {'version': None, 'checked': 0.0}
+_monthly_counts_cache = {}
+
+
+def sync_dataset_version(force=False):
+    """Polls the change log written by `publish_change` for versions newer than the last one
+    read, at most once per `VERSION_POLL_PERIOD` unless `force`. When there are any, only the months listed in the change
+    log are refreshed: their rows in the cached hot window are re-read from the db and their
+    entries in `_monthly_counts_cache` are dropped. Returns the months refreshed.
+    """
+    now = time.time()
+    if not force and now - _dataset_state['checked'] < VERSION_POLL_PERIOD:
+        return []
+    _dataset_state['checked'] = now
+    db = get_client().get_database("crime")
+    seen = _dataset_state['version']
+    if seen is None:
+        # first poll only records the version, caches are built from scratch
+        latest = db.get_collection("changes").find_one({}, sort=[('version', pymongo.DESCENDING)])
+        _dataset_state['version'] = 0 if latest is None else latest['version']
+        return []
+    # `changes` is the source of truth: `meta` is bumped before the change is inserted, so a
+    # version taken from `meta` could skip a change that is not readable yet
+    changes = list(db.get_collection("changes").find({'version': {'$gt': seen}})
+                   .sort('version', pymongo.ASCENDING))
+    if len(changes) == 0:
+        return []
+    _dataset_state['version'] = changes[-1]['version']
+    months = sorted(set(month for change in changes for month in change['months']))
+    for month in months:
+        _monthly_counts_cache.pop(month, None)
+    hot = _fetch_all_crime_as_df_cache.get('cache')
+    if changes[0]['version'] > seen + 1:
+        # versions in between expired (see `CHANGES_TTL`) or are not readable yet, so the
+        # months they touched are unknown: drop everything cached
+        _monthly_counts_cache.clear()
+        _fetch_all_crime_as_df_cache.pop('cache', None)
+        logger.info("version {} -> {}, change log has a gap, caches dropped".format(
+            seen, _dataset_state['version']))
+        return months
+    if hot is None:
+        _fetch_all_crime_as_df_cache.pop('cache', None)    # an empty db may have been filled
+    elif len(months) > 0:
+        collection = db.get_collection("crime")
+        fresh = [pd.DataFrame.from_records(list(collection.find(
+            {'arst_date': {'$gte': start, '$lt': end}}, {'_id': 0})))
+            for start, end in map(partitions.month_range, months)]
+        fresh = [_prepare_crime_df(f) for f in fresh if len(f) > 0]
+        kept = hot[~hot['month'].dt.strftime('%Y-%m').isin(months)]
+        _fetch_all_crime_as_df_cache['cache'] = pd.concat([kept] + fresh, ignore_index=True, sort=False)
+    logger.info("version {} -> {}, refreshed months={}".format(seen, _dataset_state['version'], months))
+    return months
+
+
+_dataset_source = {'fn': None, 'df': None}
+
+
+def set_dataset_source(fn):
+    """Makes `fetch_crime_as_df` read from the DataFrame returned by `fn` (e.g. the shared
+    read-only dataset of `shared_data.attached_dataset`) instead of the db and partition files.
+    `fn` may return None while no dataset is available.
+    """
+    _dataset_source['fn'] = fn
+
+
+def _shared_dataset():
+    if _dataset_source['fn'] is None:
+        return None
+    df = _dataset_source['fn']()
+    if df is not _dataset_source['df']:
+        _dataset_source['df'] = df
+        _monthly_counts_cache.clear()     # counts were computed from the previous dataset
+    return df
+
+
+def fetch_crime_as_df(start=None, end=None, allow_cached=False):
+    """Returns records with `start <= arst_date <= end` as a DataFrame, or None if there are none.
+    Frozen partitions are pruned by their min/max dates and read lazily, so only months in the
+    requested range are loaded; the hot window comes from `fetch_all_crime_as_df`. With a
+    source from `set_dataset_source`, the range is cut from that dataset instead.
+    """
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end) + pd.Timedelta(days=1)   # inclusive end day
+    shared = _shared_dataset()
+    if shared is not None:
+        frames = [shared]
+    else:
+        manifest = partitions.read_manifest()
+        names = partitions.prune(manifest,
+                                 None if start is None else start.strftime(partitions.DATE_FORMAT),
+                                 None if end is None else end.strftime(partitions.DATE_FORMAT))
+        frames = [_fetch_partition_as_df(name) for name in names]
+        hot = fetch_all_crime_as_df(allow_cached=allow_cached)
+        if hot is not None:
+            frames.append(hot)
+    if len(frames) == 0:
+        return None
+    if shared is None and any(manifest[name].get('seq', 0) > 0 for name in names):
+        df = partitions.newest_versions(frames)      # a month was re-frozen with updated rows
+    else:
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True, sort=False)
+    if start is not None:
+        df = df[df['arst_date'] >= start]
+    if end is not None:
+        df = df[df['arst_date'] < end]
+    return df.copy() if len(df) > 0 else None
+
+
+def fetch_monthly_counts(start, end):
+    """Returns a DataFrame of crime counts indexed by `month` with one column per
+    `grp_description`, for months from `start` to `end` inclusive. Counts are cached per month
+    until `sync_dataset_version` sees a change for that month, or a new shared dataset is
+    attached, which drops all of them.
+    """
+    sync_dataset_version()
+    _shared_dataset()      # may switch generations even when every month is cached
+    for month in pd.period_range(start, end, freq='M').to_timestamp():
+        key = month.strftime('%Y-%m')
+        if key not in _monthly_counts_cache:
+            df = fetch_crime_as_df(month, month + pd.DateOffset(months=1, days=-1), allow_cached=True)
+            _monthly_counts_cache[key] = (pd.Series(dtype='int64') if df is None
+                                          else df.groupby('grp_description').size())
+    counts = {month: _monthly_counts_cache[month.strftime('%Y-%m')]
+              for month in pd.period_range(start, end, freq='M').to_timestamp()}
+    return pd.DataFrame(counts).T.fillna(0).astype('int64')
+
+
 
 if __name__ == '__main__':
     print(fetch_all_crime_as_df())
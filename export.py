@@ -0,0 +1,196 @@
+import io
+import csv
+import json
+import math
+import zlib
+import logging
+import pandas as pd
+import pyarrow as pa
+import utils
+import partitions
+from database import iter_crime
+
+# Flat fields of the arrest records, in the order the data source returns them (see the sample
+# rows in ETL_EDA.ipynb; `bgk_location` is spelled that way upstream). CSV and Arrow need a fixed
+# schema and skip the nested `location_1`, which repeats `lat`/`lon`; NDJSON keeps every field.
+EXPORT_COLUMNS = ['rpt_id', 'report_type', 'arst_date', 'time', 'area', 'area_desc', 'rd', 'age',
+                  'sex_cd', 'descent_cd', 'chrg_grp_cd', 'grp_description', 'arst_typ_cd',
+                  'charge', 'chrg_desc', 'dispo_desc', 'location', 'crsst', 'lat', 'lon',
+                  'bkg_date', 'bkg_time', 'bgk_location', 'bkg_loc_cd']
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson',
+           'arrow': 'application/vnd.apache.arrow.stream'}
+EXPORT_BATCH_SIZE = 10000
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+
+def parse_filters(args):
+    """Returns export filters from request arguments `start`, `end` (inclusive, YYYY-MM-DD),
+    `category` and `area` (comma separated) and `bbox` (min_lon,min_lat,max_lon,max_lat).
+    Raises ValueError on malformed values.
+    """
+    def _split(value):
+        return [v.strip() for v in value.split(',') if v.strip()] if value else None
+
+    bbox = _split(args.get('bbox'))
+    if bbox is not None:
+        bbox = [float(v) for v in bbox]
+        if len(bbox) != 4:
+            raise ValueError("bbox needs min_lon,min_lat,max_lon,max_lat")
+    start, end = args.get('start'), args.get('end')
+    return {'start': pd.Timestamp(start).strftime(partitions.DATE_FORMAT) if start else None,
+            'end': (pd.Timestamp(end) + pd.Timedelta(days=1)).strftime(
+                partitions.DATE_FORMAT) if end else None,
+            'category': _split(args.get('category')),
+            'area': _split(args.get('area')),
+            'bbox': bbox}
+
+
+def mongo_query(filters):
+    """Returns the MongoDB query for the indexed part of `filters`; `bbox` is applied per record
+    because coordinates are stored as strings.
+    """
+    query = {}
+    if filters['start'] or filters['end']:
+        query['arst_date'] = {}
+        if filters['start']:
+            query['arst_date']['$gte'] = filters['start']
+        if filters['end']:
+            query['arst_date']['$lt'] = filters['end']
+    if filters['category']:
+        query['grp_description'] = {'$in': filters['category']}
+    if filters['area']:
+        query['area_desc'] = {'$in': filters['area']}
+    return query
+
+
+def _matches(record, filters):
+    if filters['start'] and not record.get('arst_date', '') >= filters['start']:
+        return False
+    if filters['end'] and not record.get('arst_date', '') < filters['end']:
+        return False
+    if filters['category'] and record.get('grp_description') not in filters['category']:
+        return False
+    if filters['area'] and record.get('area_desc') not in filters['area']:
+        return False
+    if filters['bbox']:
+        try:
+            lon, lat = float(record['lon']), float(record['lat'])
+        except (KeyError, TypeError, ValueError):
+            return False
+        min_lon, min_lat, max_lon, max_lat = filters['bbox']
+        return min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+    return True
+
+
+def _clean(record):
+    """Returns `record` with float NaN values, which `upsert_crime` stores for fields missing in
+    a batch, replaced by None so every format writes them as null/empty.
+    """
+    return {k: None if isinstance(v, float) and math.isnan(v) else v for k, v in record.items()}
+
+
+def iter_records(filters, batch_size=EXPORT_BATCH_SIZE):
+    """Yields matching records as lists of dicts: frozen partitions pruned by date range first,
+    skipping rows superseded by a later file, then the hot window from an indexed db cursor.
+    At most one batch (plus the superseded `rpt_id`s of one file) is held in memory.
+    """
+    manifest = partitions.read_manifest()
+    names = partitions.prune(manifest, filters['start'], filters['end'])
+    for name in names:
+        superseded = partitions.superseded_ids(manifest, name)
+        for batch in partitions.iter_partition(name, batch_size):
+            chunk = [_clean(record) for record in batch
+                     if record['rpt_id'] not in superseded and _matches(record, filters)]
+            if len(chunk) > 0:
+                yield chunk
+    check_bbox = dict(filters, start=None, end=None, category=None, area=None)
+    for batch in iter_crime(mongo_query(filters), batch_size):
+        chunk = [_clean(record) for record in batch if _matches(record, check_bbox)]
+        if len(chunk) > 0:
+            yield chunk
+
+
+def encode_csv(batches):
+    """Yields CSV bytes of `EXPORT_COLUMNS`, header first, one piece per batch.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def encode_ndjson(batches):
+    """Yields newline-delimited JSON bytes with every record field, one piece per batch.
+    """
+    for batch in batches:
+        yield ''.join(json.dumps(record, default=str) + '\n' for record in batch).encode('utf-8')
+
+
+class _StreamSink(object):
+    """Write-only file object for the Arrow stream writer; `drain` hands out the bytes written
+    so far, so the stream is never accumulated in memory.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def encode_arrow(batches):
+    """Yields an Arrow IPC stream of `EXPORT_COLUMNS` as strings, one record batch per batch.
+    """
+    schema = pa.schema([(column, pa.string()) for column in EXPORT_COLUMNS])
+    sink = _StreamSink()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+    for batch in batches:
+        columns = [pa.array([None if record.get(column) is None else str(record[column])
+                             for record in batch], type=pa.string())
+                   for column in EXPORT_COLUMNS]
+        writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {'csv': encode_csv, 'ndjson': encode_ndjson, 'arrow': encode_arrow}
+
+
+def gzip_stream(pieces, level=6):
+    """Gzip-compresses the byte `pieces` incrementally.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)   # wbits=31 writes a gzip header
+    for piece in pieces:
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(filters, fmt='csv', gzip=True, batch_size=EXPORT_BATCH_SIZE):
+    """Returns a generator of the encoded (and optionally gzipped) export of records matching
+    `filters` in format `fmt`.
+    """
+    logger.info("format={}, gzip={}, filters={}".format(fmt, gzip, filters))
+    pieces = ENCODERS[fmt](iter_records(filters, batch_size))
+    return gzip_stream(pieces) if gzip else pieces
@@ -0,0 +1,67 @@
+import json
+import logging
+import math
+import time
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.graph_objects as go
+import utils
+
+# Plotly figures travel as JSON lists here: typed-array (`bdata`) encoding needs plotly >= 6,
+# whose recent releases drop `scattermapbox`, so short rounded decimals are the compact form.
+MAX_FIGURE_BYTES = 1500000   # per-figure payload limit before decimation kicks in
+COORD_DECIMALS = 5           # ~1 meter, well below marker size at any useful zoom
+BYTES_PER_POINT = 20         # estimated lat+lon JSON bytes per map point
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+
+def encode_coords(values):
+    """Returns `values` as float64 rounded to `COORD_DECIMALS`, so their JSON repr stays short.
+    """
+    return np.round(np.asarray(values, dtype=np.float64), COORD_DECIMALS)
+
+
+def decimate(df, max_points):
+    """Returns `df` unchanged when it has at most `max_points` rows, otherwise every k-th row so
+    that the result fits. Striding keeps the spatial/temporal spread of the original rows.
+    """
+    if len(df) <= max_points:
+        return df
+    step = int(math.ceil(len(df) / float(max_points)))
+    logger.info("decimating {} points by {} to fit {} points".format(len(df), step, max_points))
+    return df.iloc[::step]
+
+
+def crime_map_figure(df_map, title='Crime map', max_bytes=MAX_FIGURE_BYTES):
+    """Returns a WebGL `scattermapbox` figure of `df_map` with one trace per `area_desc`.
+    Areas are factorized into category codes, so each area name is sent once as a trace name
+    instead of once per point; coordinates go through `encode_coords`. Points are decimated to
+    fit `max_bytes`; None disables the limit.
+    """
+    if max_bytes is not None:
+        df_map = decimate(df_map, max(1, max_bytes // BYTES_PER_POINT))
+    codes, areas = pd.factorize(df_map['area_desc'])
+    lat = encode_coords(df_map['lat'])
+    lon = encode_coords(df_map['lon'])
+    fig = go.Figure()
+    for code, area in enumerate(areas):
+        mask = codes == code
+        fig.add_trace(go.Scattermapbox(lat=lat[mask], lon=lon[mask], mode='markers', name=area,
+                                       marker=dict(size=12, opacity=0.5),
+                                       hovertemplate='lat=%{lat}<br>lon=%{lon}'))
+    center = dict(lat=float(lat.mean()), lon=float(lon.mean())) if len(lat) else None
+    fig.update_layout(mapbox=dict(style='stamen-terrain', zoom=10, center=center), height=500,
+                      legend_title_text='area_desc', margin={"r": 0, "t": 0, "l": 0, "b": 0},
+                      title=title)
+    return fig
+
+
+def payload_stats(fig):
+    """Returns `(bytes, seconds)` needed to serialize `fig` the way dash sends it to the browser.
+    """
+    start = time.perf_counter()
+    payload = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+    return len(payload.encode('utf-8')), time.perf_counter() - start
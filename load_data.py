@@ -1,15 +1,29 @@
+import logging
+import utils
 from data_acquire import download_crime
+from database import freeze_history, get_client, rebuild_stats
 
-import pymongo
 CRIME_SOURCE = "data.lacity.org"
-client = pymongo.MongoClient()
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
 
 def load(start_date):
     results = download_crime(url=CRIME_SOURCE, start_date = start_date)
-    db = client.get_database("crime")
+    rows = len(results)
+    results = list({r['rpt_id']: r for r in results}.values())   # keep the last arrival of each rpt_id
+    duplicates = rows - len(results)
+    db = get_client().get_database("crime")
     collection = db.get_collection("crime")
     collection.drop() # empty the database before insert many
     collection.insert_many(results)
+    logger.info("rows={}, duplicates={}, insert={}".format(rows, duplicates, len(results)))
+    db.get_collection("meta").update_one(
+        {'_id': 'ingest'},
+        {'$inc': {'rows': rows, 'duplicates': duplicates, 'inserts': len(results)}},
+        upsert=True)
+    rebuild_stats(results)
+    freeze_history()     # keep only the hot window in the db, history goes to partition files
         
 if __name__ == '__main__':
     load(start_date = '2018-01-01T00:00:00.000')
\ No newline at end of file
@@ -0,0 +1,145 @@
+import os
+import json
+import logging
+import pandas as pd
+import pyarrow.parquet as pq
+import utils
+
+# Historical months are frozen into immutable parquet files under `PARTITION_DIR`; only the
+# last `HOT_WINDOW_DAYS` stay in the MongoDB collection where `upsert_crime` can change them.
+PARTITION_DIR = 'partitions'
+MANIFEST_FILE = os.path.join(PARTITION_DIR, 'manifest.json')
+HOT_WINDOW_DAYS = 35
+COMPRESSION = 'zstd'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.000'   # `arst_date` as stored by the data source
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+
+def month_key(date):
+    """Returns the `YYYY-MM` partition key of `date`.
+    """
+    return pd.Timestamp(date).strftime('%Y-%m')
+
+
+def month_range(key):
+    """Returns `[start, end)` of the month `key` as `arst_date` strings.
+    """
+    start = pd.Timestamp(key + '-01')
+    end = start + pd.DateOffset(months=1)
+    return start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT)
+
+
+def read_manifest():
+    """Returns the partition manifest, a dict of file name to
+    `{'month', 'min_date', 'max_date', 'rows'}`. Empty when nothing has been frozen yet.
+    """
+    try:
+        with open(MANIFEST_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(manifest):
+    tmp = MANIFEST_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, MANIFEST_FILE)      # readers never see a half-written manifest
+
+
+def prune(manifest, start=None, end=None):
+    """Returns file names in `manifest` whose `[min_date, max_date]` overlaps `[start, end)`.
+    `start` and `end` are `arst_date` strings; None leaves that side open. Names are ordered by
+    month and then by write order, so a record in a later file supersedes the same `rpt_id` in
+    an earlier one.
+    """
+    return sorted((name for name, stats in manifest.items()
+                   if (start is None or stats['max_date'] >= start) and
+                   (end is None or stats['min_date'] < end)),
+                  key=lambda name: (manifest[name]['month'], manifest[name].get('seq', 0)))
+
+
+def superseded_ids(manifest, name):
+    """Returns the `rpt_id`s of partition `name` that were rewritten in a later file of the
+    same month, i.e. the rows of `name` readers must skip.
+    """
+    stats = manifest[name]
+    later = [other for other, other_stats in manifest.items()
+             if other_stats['month'] == stats['month'] and
+             other_stats.get('seq', 0) > stats.get('seq', 0)]
+    return set(rpt_id for other in later for rpt_id in read_partition(other, columns=['rpt_id'])['rpt_id'])
+
+
+def newest_versions(frames):
+    """Concatenates partition `frames` given in `prune` order and keeps the last version of
+    every `rpt_id`.
+    """
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    return df[~df['rpt_id'].duplicated(keep='last')]
+
+
+def freeze_month(collection, key):
+    """Moves the records of month `key` from `collection` into a new immutable partition file.
+    When the month was frozen before, the records that are new or differ from their frozen
+    version go to an extra file that supersedes the earlier ones, so existing files are never
+    rewritten. Returns the name of the file written, or None if nothing needed writing.
+    """
+    start, end = month_range(key)
+    query = {'arst_date': {'$gte': start, '$lt': end}}
+    df = pd.DataFrame.from_records(list(collection.find(query, {'_id': 0})))
+    if len(df) == 0:
+        return None
+    manifest = read_manifest()
+    existing = [name for name in prune(manifest) if manifest[name]['month'] == key]
+    if existing:
+        frozen = newest_versions([read_partition(name) for name in existing])
+        frozen_hashes = utils.row_hashes(frozen)
+        position = pd.Index(frozen['rpt_id']).get_indexer(df['rpt_id'])
+        same = (position >= 0) & (frozen_hashes.to_numpy()[position] == utils.row_hashes(df).to_numpy())
+        df = df[~same]
+    seq = len(existing)
+    name = 'crime-{}.{}.parquet'.format(key, seq) if seq else 'crime-{}.parquet'.format(key)
+    if len(df) > 0:
+        os.makedirs(PARTITION_DIR, exist_ok=True)
+        path = os.path.join(PARTITION_DIR, name)
+        df.to_parquet(path + '.tmp', engine='pyarrow', compression=COMPRESSION, index=False)
+        os.replace(path + '.tmp', path)
+        manifest[name] = {'month': key, 'seq': seq, 'min_date': df['arst_date'].min(),
+                          'max_date': df['arst_date'].max(), 'rows': int(len(df))}
+        _write_manifest(manifest)
+    else:
+        name = None
+    deleted = collection.delete_many(query).deleted_count
+    logger.info("partition={}, rows={}, removed_from_db={}".format(name, len(df), deleted))
+    return name
+
+
+def freeze_history(collection, hot_days=HOT_WINDOW_DAYS, now=None):
+    """Freezes every complete month that ends before the hot window of `hot_days` days.
+    """
+    now = pd.Timestamp.now() if now is None else pd.Timestamp(now)
+    cutoff = month_key(now - pd.Timedelta(days=hot_days))   # this month and later stay hot
+    oldest = collection.find_one({'arst_date': {'$lt': month_range(cutoff)[0]}},
+                                 sort=[('arst_date', 1)])
+    if oldest is None:
+        return []
+    keys = pd.period_range(month_key(oldest['arst_date']), cutoff, freq='M').strftime('%Y-%m')
+    frozen = [freeze_month(collection, key) for key in keys[:-1]]
+    return [name for name in frozen if name is not None]
+
+
+def read_partition(name, columns=None):
+    """Returns partition file `name` as a DataFrame, optionally reading only `columns`.
+    """
+    return pd.read_parquet(os.path.join(PARTITION_DIR, name), engine='pyarrow', columns=columns)
+
+
+def iter_partition(name, batch_size=10000):
+    """Yields the records of partition file `name` as lists of dicts, one row group slice of
+    at most `batch_size` rows at a time, without reading the whole file into memory.
+    """
+    parquet_file = pq.ParquetFile(os.path.join(PARTITION_DIR, name))
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield batch.to_pylist()
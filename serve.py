@@ -0,0 +1,87 @@
+import os
+import time
+import logging
+import multiprocessing
+import gunicorn.app.base
+import utils
+
+# Production serving: gunicorn runs `WORKERS` processes of the dash app. A refresher process builds
+# the processed dataset once and publishes it through `shared_data`; workers map it read-only. The
+# refresher process watches the dataset version published by ingest and republishes on changes.
+# It is spawned, not forked, and does all db and pandas work, so the master stays single-threaded
+# and forks workers (including replacements at any time) without inheriting held locks.
+PORT = 1050
+WORKERS = int(os.environ.get('LACRIME_WORKERS', multiprocessing.cpu_count()))
+REFRESH_PERIOD = 30          # second
+STARTUP_TIMEOUT = 600        # second, longest the master waits for the first publish
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+
+def publish_dataset():
+    """Builds the processed dataset from the db and partition files and publishes it as a new
+    shared generation. Returns the generation, or None if there is no data yet.
+    """
+    import database
+    import shared_data
+    df = database.fetch_crime_as_df(allow_cached=True)
+    if df is None:
+        return None
+    return shared_data.publish(df)
+
+
+def _refresher(ready):
+    import database
+    try:
+        database.sync_dataset_version(force=True)     # remember the version the build starts from
+        publish_dataset()
+    except Exception as e:
+        logger.warning("initial publish failed, workers start without a shared dataset: {}".format(e))
+    ready.set()
+    while True:
+        time.sleep(REFRESH_PERIOD)
+        try:
+            if database.sync_dataset_version(force=True):
+                publish_dataset()
+        except Exception as e:
+            logger.warning("refresher ignores exception and continues: {}".format(e))
+
+
+def on_starting(server):
+    """gunicorn hook, runs once in the master before any worker is forked: spawns the refresher
+    process and waits for its first publish."""
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    context.Process(target=_refresher, args=(ready,), daemon=True).start()
+    if not ready.wait(STARTUP_TIMEOUT):
+        logger.warning("no dataset published after {}s, starting workers anyway".format(STARTUP_TIMEOUT))
+
+
+def post_fork(server, worker):
+    """gunicorn hook, runs in every worker: read the shared dataset instead of loading a
+    private copy."""
+    import database
+    import shared_data
+    database.set_dataset_source(shared_data.attached_dataset)
+
+
+class CrimeMapApplication(gunicorn.app.base.BaseApplication):
+    """Runs `app.server` under gunicorn with the hooks above."""
+
+    def __init__(self, options=None):
+        self.options = options or {}
+        super(CrimeMapApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app.server
+
+
+if __name__ == '__main__':
+    CrimeMapApplication({'bind': '0.0.0.0:{}'.format(PORT), 'workers': WORKERS,
+                         'on_starting': on_starting, 'post_fork': post_fork}).run()
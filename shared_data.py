@@ -0,0 +1,130 @@
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+import utils
+
+# The processed dataset is published once per host as a flat columnar file on tmpfs. Worker
+# processes memory-map it read-only, so every worker shares the same physical pages instead of
+# holding its own copy. A new generation is written next to the old one and switched to by
+# atomically replacing `CURRENT_FILE`.
+SHARED_DIR = os.environ.get('LACRIME_SHARED_DIR',
+                            '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+PREFIX = 'lacrime-dataset'
+CURRENT_FILE = os.path.join(SHARED_DIR, PREFIX + '.current')
+SHARED_COLUMNS = ['arst_date', 'month', 'grp_description', 'area_desc', 'lat', 'lon']
+CATEGORY_COLUMNS = ['grp_description', 'area_desc']
+NUMERIC_COLUMNS = ['lat', 'lon']
+ALIGNMENT = 64
+CHECK_PERIOD = 1                 # second, minimum interval between generation checks
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+
+def _path(generation):
+    return os.path.join(SHARED_DIR, '{}-{}.bin'.format(PREFIX, generation))
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _encode(df):
+    """Yields `(name, array, categories)` for every shared column: categories as integer codes,
+    coordinates as float64 and dates as datetime64.
+    """
+    for name in SHARED_COLUMNS:
+        if name in CATEGORY_COLUMNS:
+            categorical = pd.Categorical(df[name])
+            yield name, categorical.codes, [str(c) for c in categorical.categories]
+        elif name in NUMERIC_COLUMNS:
+            yield name, pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=np.float64), None
+        else:
+            yield name, df[name].to_numpy(dtype='datetime64[ns]'), None
+
+
+def current_generation():
+    """Returns the generation workers should be reading, 0 if nothing was published.
+    """
+    try:
+        with open(CURRENT_FILE) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def publish(df):
+    """Writes `SHARED_COLUMNS` of `df` as a new generation and makes it current. Files of
+    older generations are unlinked; workers that still map them keep their pages until they
+    switch. Returns the new generation.
+    """
+    generation = current_generation() + 1
+    columns, arrays, offset = [], [], 0
+    for name, array, categories in _encode(df):
+        array = np.ascontiguousarray(array)
+        columns.append({'name': name, 'dtype': array.dtype.str, 'offset': offset,
+                        'categories': categories})
+        arrays.append(array)
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'rows': len(df), 'columns': columns}).encode('utf-8')
+    data_start = _align(8 + len(header))
+    tmp = _path(generation) + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)) + header)
+        for column, array in zip(columns, arrays):
+            f.seek(data_start + column['offset'])
+            f.write(array.tobytes())
+    os.replace(tmp, _path(generation))
+    with open(CURRENT_FILE + '.tmp', 'w') as f:
+        f.write(str(generation))
+    os.replace(CURRENT_FILE + '.tmp', CURRENT_FILE)
+    for name in os.listdir(SHARED_DIR):
+        if name.startswith(PREFIX + '-') and name != os.path.basename(_path(generation)):
+            os.remove(os.path.join(SHARED_DIR, name))
+    logger.info("generation={}, rows={}, bytes={}".format(generation, len(df), data_start + offset))
+    return generation
+
+
+def load(generation):
+    """Returns generation `generation` as a DataFrame backed by a read-only memory map; the
+    arrays are views into the shared pages, not copies.
+    """
+    with open(_path(generation), 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_size = struct.unpack_from('<Q', buffer, 0)[0]
+    header = json.loads(buffer[8:8 + header_size].decode('utf-8'))
+    data_start = _align(8 + header_size)
+    columns = {}
+    for column in header['columns']:
+        array = np.frombuffer(buffer, dtype=column['dtype'], count=header['rows'],
+                              offset=data_start + column['offset'])
+        if column['categories'] is not None:
+            array = pd.Categorical.from_codes(array, categories=column['categories'])
+        columns[column['name']] = array
+    return pd.DataFrame(columns, copy=False)
+
+
+_attached = {'generation': 0, 'df': None, 'checked': 0.0}
+
+
+def attached_dataset():
+    """Returns the current shared dataset, switching to a newer generation at most once per
+    `CHECK_PERIOD`, or None if nothing was published.
+    """
+    now = time.time()
+    if now - _attached['checked'] >= CHECK_PERIOD:
+        _attached['checked'] = now
+        generation = current_generation()
+        if generation != _attached['generation']:
+            try:
+                _attached['df'] = load(generation) if generation > 0 else None
+                _attached['generation'] = generation
+            except FileNotFoundError:
+                pass         # superseded while switching; the next check picks up the newest
+    return _attached['df']
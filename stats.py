@@ -0,0 +1,140 @@
+import math
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+import pymongo
+import utils
+
+# Daily arrest counts per area and per crime group, with exponentially weighted mean/variance
+# kept online in `rolling_stats`. A day is only scored once it has left the download window,
+# which keeps re-fetching (and adding to) the last few days, boundary day included. The last
+# settled day all keys were advanced to is kept in `meta` as `{'_id': 'stats', 'settled': day}`.
+STAT_KEYS = {'area': 'area_desc', 'category': 'grp_description'}
+EWM_SPAN = 28                    # days
+EWM_ALPHA = 2.0 / (EWM_SPAN + 1)
+SETTLE_DAYS = utils.DOWNLOAD_WINDOW_DAYS + 1    # now - SETTLE_DAYS is the newest day outside the window
+MIN_HISTORY_DAYS = 14            # no z-score until the mean has seen this many days
+ANOMALY_Z = 3.0
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+
+def _day(value):
+    return str(value)[:10]       # `arst_date` strings and timestamps both start with YYYY-MM-DD
+
+
+def ewm_update(mean, var, x, alpha=EWM_ALPHA):
+    """Returns `(mean, var)` after adding observation `x` to an exponentially weighted mean and
+    variance, in O(1).
+    """
+    diff = x - mean
+    increment = alpha * diff
+    return mean + increment, (1 - alpha) * (var + diff * increment)
+
+
+def update_stats(db, records, now=None):
+    """Adds newly inserted `records` (dicts) to the daily counts in collection `daily_stats`,
+    then advances the rolling state of every key they touch up to the last settled day, scoring
+    each settled day with its z-score against the state before it. Once per settled day, every
+    other key in `rolling_stats` is advanced too, so keys without new arrests get their zero
+    days scored. Work is proportional to the batch, the number of keys and the days elapsed
+    since the last update, never to the stored history. Records arriving for an already scored
+    day still count, but do not change its score.
+    """
+    counts = Counter()
+    for record in records:
+        for kind, field in STAT_KEYS.items():
+            # fields missing from a batch arrive as float NaN, e.g. `grp_description` of RFC rows
+            if isinstance(record.get(field), str) and record[field] and record.get('arst_date'):
+                counts[(kind, record[field], _day(record['arst_date']))] += 1
+    if len(counts) > 0:
+        db.get_collection('daily_stats').bulk_write(
+            [pymongo.UpdateOne({'_id': '|'.join(key)},
+                               {'$inc': {'count': n},
+                                '$setOnInsert': {'kind': key[0], 'key': key[1], 'day': key[2]}},
+                               upsert=True)
+             for key, n in counts.items()], ordered=False)
+    now = datetime.now() if now is None else now
+    settled = (now - timedelta(days=SETTLE_DAYS)).strftime('%Y-%m-%d')
+    keys = set((kind, key) for kind, key, _ in counts)
+    marker = db.get_collection('meta').find_one({'_id': 'stats'}) or {'settled': None}
+    if marker['settled'] != settled:
+        keys |= set((doc['kind'], doc['key']) for doc in db.get_collection('rolling_stats').find(
+            {'last_day': {'$lt': settled}}, {'kind': 1, 'key': 1}))
+    for kind, key in keys:
+        _advance(db, kind, key, settled)
+    if marker['settled'] != settled:
+        db.get_collection('meta').update_one({'_id': 'stats'}, {'$set': {'settled': settled}},
+                                             upsert=True)
+    if len(keys) > 0:
+        logger.info("records={}, daily_counts={}, advanced_keys={}".format(
+            len(records), len(counts), len(keys)))
+    return len(counts)
+
+
+def _advance(db, kind, key, settled):
+    """Folds the days after the last scored one, up to `settled`, into the rolling state of
+    `(kind, key)`. Days without arrests count as zero.
+    """
+    rolling = db.get_collection('rolling_stats')
+    daily = db.get_collection('daily_stats')
+    state = rolling.find_one({'_id': kind + '|' + key}) or {'last_day': None, 'mean': 0.0,
+                                                            'var': 0.0, 'days': 0}
+    query = {'kind': kind, 'key': key, 'day': {'$lte': settled}}
+    if state['last_day'] is not None:
+        query['day']['$gt'] = state['last_day']
+    observed = {doc['day']: doc['count'] for doc in daily.find(query, {'day': 1, 'count': 1})}
+    if len(observed) == 0 and state['last_day'] is None:
+        return
+    day = (datetime.strptime(state['last_day'], '%Y-%m-%d') + timedelta(days=1)
+           if state['last_day'] is not None else datetime.strptime(min(observed), '%Y-%m-%d'))
+    updates = []
+    mean, var, days = state['mean'], state['var'], state['days']
+    while day.strftime('%Y-%m-%d') <= settled:
+        name = day.strftime('%Y-%m-%d')
+        count = observed.get(name, 0)
+        z = (count - mean) / math.sqrt(var) if days >= MIN_HISTORY_DAYS and var > 0 else None
+        if z is not None and (count > 0 or abs(z) >= ANOMALY_Z):
+            updates.append(pymongo.UpdateOne(
+                {'_id': '|'.join((kind, key, name))},
+                {'$set': {'z': z, 'mean': mean},
+                 '$setOnInsert': {'kind': kind, 'key': key, 'day': name, 'count': count}},
+                upsert=True))
+        mean, var = (count, 0.0) if days == 0 else ewm_update(mean, var, count)
+        days += 1
+        day += timedelta(days=1)
+    if len(updates) > 0:
+        daily.bulk_write(updates, ordered=False)
+    rolling.replace_one({'_id': kind + '|' + key},
+                        {'kind': kind, 'key': key, 'mean': mean,
+                         'last_day': (day - timedelta(days=1)).strftime('%Y-%m-%d'),
+                         'var': var, 'days': days}, upsert=True)
+
+
+def ensure_indexes(db):
+    """Creates the `daily_stats` indexes used by `_advance` and `fetch_anomalies`; without the
+    `(kind, key, day)` one every update scans the whole statistics collection.
+    """
+    db.get_collection('daily_stats').create_index([('day', pymongo.ASCENDING), ('kind', pymongo.ASCENDING)])
+    db.get_collection('daily_stats').create_index([('kind', pymongo.ASCENDING), ('key', pymongo.ASCENDING),
+                                                  ('day', pymongo.ASCENDING)])
+
+
+def reset_stats(db):
+    """Drops all statistics, e.g. before rebuilding them from a full reload.
+    """
+    db.get_collection('daily_stats').drop()
+    db.get_collection('rolling_stats').drop()
+    db.get_collection('meta').delete_one({'_id': 'stats'})
+    ensure_indexes(db)
+
+
+def fetch_anomalies(db, start, end, threshold=ANOMALY_Z, limit=10):
+    """Returns up to `limit` scored days between `start` and `end` (inclusive, YYYY-MM-DD)
+    whose |z| is at least `threshold`, most unusual first. Reads only the statistics.
+    """
+    query = {'day': {'$gte': _day(start), '$lte': _day(end)},
+             '$or': [{'z': {'$gte': threshold}}, {'z': {'$lte': -threshold}}]}
+    docs = list(db.get_collection('daily_stats').find(query, {'_id': 0}))
+    return sorted(docs, key=lambda doc: -abs(doc['z']))[:limit]
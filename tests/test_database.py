@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+import database
+
+# Shaped like the rows returned by the data source, see ETL_EDA.ipynb.
+RECORDS = [
+    {'rpt_id': '190129845', 'report_type': 'RFC', 'arst_date': '2019-12-11T00:00:00.000',
+     'time': '1510', 'area': '01', 'area_desc': 'Central', 'rd': '0152', 'age': '24',
+     'sex_cd': 'M', 'descent_cd': 'H', 'arst_typ_cd': 'I', 'charge': '63.44B24LAM',
+     'dispo_desc': 'MISDEMEANOR COMPLAINT FILED', 'location': '5TH', 'crsst': 'HILL',
+     'lat': '34.0489', 'lon': '-118.2519',
+     'location_1': {'type': 'Point', 'coordinates': [-118.2519, 34.0489]}},
+    {'rpt_id': '5835314', 'report_type': 'BOOKING', 'arst_date': '2019-12-31T00:00:00.000',
+     'time': '1205', 'area': '09', 'area_desc': 'Van Nuys', 'rd': '0935', 'age': '47',
+     'sex_cd': 'M', 'descent_cd': 'W', 'chrg_grp_cd': '16', 'grp_description': 'Narcotic Drug Laws',
+     'arst_typ_cd': 'M', 'charge': '11350(A)HS', 'chrg_desc': 'POSSESSION OF CONTROLLED SUBSTANCE',
+     'dispo_desc': 'FELONY COMPLAINT FILED', 'location': '14400    ERWIN STREET',
+     'lat': '34.1837', 'lon': '-118.4465',
+     'location_1': {'type': 'Point', 'coordinates': [-118.4465, 34.1837]},
+     'bkg_date': '2019-12-31T00:00:00.000', 'bkg_time': '1212',
+     'bgk_location': 'VALLEY - JAIL DIV', 'bkg_loc_cd': '4279'},
+]
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    database._last_written['hashes'] = None
+    yield
+    database._last_written['hashes'] = None
+
+
+def test_dedup_batch_keeps_newest_duplicate():
+    newer = dict(RECORDS[0], dispo_desc='FELONY COMPLAINT FILED')
+    df, hashes, duplicates, unchanged, late = database.dedup_batch(
+        pd.DataFrame.from_records(RECORDS + [newer]))
+    assert duplicates == 1
+    assert (unchanged, late) == (0, 0)
+    assert len(df) == len(hashes) == 2
+    assert df.set_index('rpt_id').loc['190129845', 'dispo_desc'] == 'FELONY COMPLAINT FILED'
+
+
+def test_dedup_batch_skips_refetched_rows():
+    first = pd.DataFrame.from_records(RECORDS)
+    _, database._last_written['hashes'], _, _, _ = database.dedup_batch(first)
+    # same content, different column order and an extra all-null column
+    again = first[list(reversed(first.columns))].assign(extra=None)
+    df, _, duplicates, unchanged, late = database.dedup_batch(again)
+    assert (len(df), duplicates, unchanged, late) == (0, 0, 2, 0)
+
+
+def test_dedup_batch_counts_late_updates():
+    _, database._last_written['hashes'], _, _, _ = database.dedup_batch(pd.DataFrame.from_records(RECORDS))
+    moved = dict(RECORDS[1], location_1={'type': 'Point', 'coordinates': [-118.4, 34.2]})
+    df, _, _, unchanged, late = database.dedup_batch(pd.DataFrame.from_records([RECORDS[0], moved]))
+    assert (unchanged, late) == (1, 1)
+    assert list(df['rpt_id']) == ['5835314']
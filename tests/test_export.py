@@ -0,0 +1,32 @@
+import io
+import json
+import pyarrow as pa
+import export
+from test_database import RECORDS
+
+
+def _export(fmt, monkeypatch):
+    # a hot-window document as written by `upsert_crime`: missing fields are float NaN
+    document = dict(RECORDS[0], chrg_grp_cd=float('nan'), grp_description=float('nan'))
+    monkeypatch.setattr(export.partitions, 'read_manifest', lambda: {})
+    monkeypatch.setattr(export, 'iter_crime', lambda query, batch_size: iter([[document]]))
+    return b''.join(export.export_stream(export.parse_filters({}), fmt, gzip=False))
+
+
+def test_ndjson_writes_nan_as_null(monkeypatch):
+    record = json.loads(_export('ndjson', monkeypatch))
+    assert record['grp_description'] is None
+    assert record['location'] == '5TH' and record['crsst'] == 'HILL'
+
+
+def test_csv_writes_nan_as_empty(monkeypatch):
+    header, row = _export('csv', monkeypatch).decode('utf-8').splitlines()
+    values = dict(zip(header.split(','), row.split(',')))
+    assert values['grp_description'] == '' and values['chrg_grp_cd'] == ''
+    assert values['location'] == '5TH'
+
+
+def test_arrow_writes_nan_as_null(monkeypatch):
+    table = pa.ipc.open_stream(io.BytesIO(_export('arrow', monkeypatch))).read_all()
+    assert table.column('grp_description').to_pylist() == [None]
+    assert table.column('crsst').to_pylist() == ['HILL']
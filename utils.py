@@ -1,6 +1,10 @@
 import sys
+import json
 import logging
 
+# `data_acquire.download_crime` re-fetches everything since 00:00 this many days ago.
+DOWNLOAD_WINDOW_DAYS = 5
+
 
 def setup_logger(logger, output_file):
     logger.setLevel(logging.INFO)
@@ -12,3 +16,38 @@ def setup_logger(logger, output_file):
     file_handler = logging.FileHandler(output_file)
     file_handler.setFormatter(logging.Formatter('%(asctime)s [%(funcName)s] %(message)s'))
     logger.addHandler(file_handler)
+
+
+def _plain(value):
+    """Returns `value` with numpy containers/scalars converted to builtins and None-valued
+    dict entries dropped, so that the same record compares equal whichever store it came from.
+    """
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)) or hasattr(value, 'tolist'):
+        value = value.tolist() if hasattr(value, 'tolist') else value
+        return [_plain(v) for v in value] if isinstance(value, list) else value
+    return value
+
+
+def _stable_str(value):
+    import pandas as pd
+    if isinstance(value, (dict, list, tuple)) or getattr(value, 'ndim', 0) > 0:
+        return json.dumps(_plain(value), sort_keys=True)
+    if pd.isna(value):
+        return None
+    return str(value)
+
+
+def row_hashes(df):
+    """Returns a uint64 hash per row of `df` that depends only on its non-null fields: columns
+    are visited in sorted order and nested values (e.g. `location_1`) are hashed as sorted JSON,
+    so column order, all-null columns and the source of the record do not change the hash.
+    """
+    import pandas as pd
+    key = pd.Series([''] * len(df), index=df.index, dtype=object)
+    for column in sorted(df.columns):
+        values = df[column].map(_stable_str).astype(object)
+        present = values.notna().to_numpy()
+        key[present] = key[present] + '\x1e' + column + '\x1f' + values[present]
+    return pd.util.hash_pandas_object(key, index=False)